@@ -1,21 +1,18 @@
 import asyncio
-import sys
 import shutil
 
 from io import StringIO
-from typing import Callable, Coroutine, Tuple
+from typing import Any, Callable, Tuple
 
 from pkgmgr.helpers import ExitSignal, connect_stdin_stdout
 
 
 from . import printer
-from .printer import TERM_STDOUT
 
 
 async def stream_output(
     stream: asyncio.StreamReader,
     suffix: str,
-    print_func: Callable[..., Coroutine],
     additional_output=None,
     show_output: bool = True,
 ):
@@ -41,15 +38,8 @@ async def stream_output(
                 additional_output.write(char)
 
             if show_output and char:
-                # if we needs prefix now, print it.
-                if printer.NEEDS_PREFIX:
-                    await print_func("", end="")
-                    printer.NEEDS_PREFIX = False
-
-                sys.stdout.write(char)
-                sys.stdout.flush()
-                if char == "\n":
-                    printer.NEEDS_PREFIX = True
+                # the printer adds the prefix at the start of each line
+                printer.write_raw(char)
 
 
 async def handle_input(writer: asyncio.StreamWriter):
@@ -108,7 +98,6 @@ async def command_runner_stream(
                 stream_output(
                     process.stdout,
                     ">&1",
-                    TERM_STDOUT,
                     additional_output=stdout_capture,
                     show_output=show_output,
                 )
@@ -120,7 +109,6 @@ async def command_runner_stream(
                 stream_output(
                     process.stderr,
                     ">&2",
-                    TERM_STDOUT,
                     additional_output=stderr_capture,
                     show_output=show_output,
                 )
@@ -166,3 +154,45 @@ async def command_runner_stream_with_output(
         stderr_capture=stderr,
     )
     return ret_code, stdout.getvalue(), stderr.getvalue()
+
+
+class LineSplitter:
+    """
+    A file-like object that calls on_line for every complete line written to it.
+    """
+
+    def __init__(self, on_line: Callable[[str], Any]):
+        self.on_line = on_line
+        self._parts: list[str] = []
+
+    def write(self, text: str):
+        *lines, rest = text.split("\n")
+        for line in lines:
+            self._parts.append(line)
+            self.on_line("".join(self._parts).rstrip("\r"))
+            self._parts.clear()
+        if rest:
+            self._parts.append(rest)
+
+    def close(self):
+        # emit the last line, if the output does not end with a newline
+        if self._parts:
+            self.on_line("".join(self._parts).rstrip("\r"))
+            self._parts.clear()
+
+
+async def command_runner_stream_lines(
+    command: list[str],
+    on_line: Callable[[str], Any],
+    show_output: bool = False,
+) -> Tuple[int, str]:
+    stdout = LineSplitter(on_line)
+    stderr = StringIO()
+    ret_code = await command_runner_stream(
+        command,
+        show_output=show_output,
+        stdout_capture=stdout,
+        stderr_capture=stderr,
+    )
+    stdout.close()
+    return ret_code, stderr.getvalue()
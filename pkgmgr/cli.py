@@ -7,7 +7,13 @@ from typing import Optional
 from pkgmgr.helpers import ExitSignal
 
 from pkgmgr import __version__, core, printer
-from pkgmgr.printer import VERBOSITY_CTX, Verbosity, aINFO, INFO
+from pkgmgr.printer import Verbosity, aINFO, INFO, set_verbosity
+
+try:
+    # optional, faster drop-in event loop
+    import uvloop  # type: ignore[import-not-found]
+except ImportError:
+    uvloop = None  # type: ignore[assignment]
 
 
 app = typer.Typer(help="Package Manager CLI", no_args_is_help=True)
@@ -73,13 +79,13 @@ def runner(
         sync=sync,
     )
     if verbose >= 4:
-        VERBOSITY_CTX.set(Verbosity.DEBUG)
+        set_verbosity(Verbosity.DEBUG)
     elif verbose >= 3:
-        VERBOSITY_CTX.set(Verbosity.INFO)
+        set_verbosity(Verbosity.INFO)
     elif verbose >= 2:
-        VERBOSITY_CTX.set(Verbosity.WARN)
+        set_verbosity(Verbosity.WARN)
     elif verbose >= 1:
-        VERBOSITY_CTX.set(Verbosity.ERROR)
+        set_verbosity(Verbosity.ERROR)
 
 
 def raise_exit():
@@ -93,14 +99,14 @@ def complete_targets(ctx: typer.Context, incomplete: str):
     global_params = ctx.parent.params
     config_dir = global_params.get("config_dir", None) or get_default_config_path()
     # silence all output during loading
-    VERBOSITY_CTX.set(Verbosity.ERROR)
+    set_verbosity(Verbosity.ERROR)
 
     async def inner():
         manager = await core.load_all(config_dir)
         return list(manager.keys())
 
     try:
-        return asyncio.run(inner())
+        return _asyncio_run(inner())
     except Exception:
         return []
 
@@ -179,9 +185,15 @@ def diff(
     _run_async(run(), args.sync)
 
 
+def _asyncio_run(coro):
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
 def _run_async(coro, sync: bool = False):
     try:
-        asyncio.run(coro)
+        _asyncio_run(coro)
     except (KeyboardInterrupt, ExitSignal):
         INFO("Exiting...")
         raise typer.Exit(1)
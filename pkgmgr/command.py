@@ -1,12 +1,13 @@
 from abc import abstractmethod, ABC
-from typing import Optional, Tuple, Union, Callable, List, Awaitable
+from typing import Any, Optional, Tuple, Union, Callable, List, Awaitable
+import copy
 import inspect
 import traceback
 
 
 from pkgmgr.printer import aDEBUG, aERROR_EXIT
 
-from .aio import command_runner_stream, command_runner_stream_with_output
+from .aio import command_runner_stream, command_runner_stream_lines, command_runner_stream_with_output
 from .helpers import ExitSignal, async_all, split_script_as_shell, T
 
 CommandResult = Tuple[bool, str, str]
@@ -27,6 +28,18 @@ class Command(ABC):
     async def run_with_output(self) -> CommandResult:
         raise NotImplementedError()
 
+    async def run_streaming(self, on_line: Callable[[str], Any]) -> CommandResult:
+        """
+        Run the command and call on_line for each line of its output.
+        The returned output is empty once its lines had been passed to on_line.
+        """
+        success, output, stderr = await self.run_with_output()
+        if isinstance(output, str):
+            for line in output.splitlines():
+                on_line(line)
+            output = ""
+        return success, output, stderr
+
     def with_replacement_part(self, part: str) -> "Command":
         raise NotImplementedError("This method is not implemented for this command type.")
 
@@ -57,9 +70,7 @@ class CompoundCommand(Command):
         return await async_all(await command.run() for command in self.commands)
 
     def with_replacement_part(self, part: str) -> "Command":
-        for command in self.commands:
-            command.with_replacement_part(part)
-        return self
+        return CompoundCommand([command.with_replacement_part(part) for command in self.commands])
 
 
 class ShellScript(Command):
@@ -72,6 +83,8 @@ class ShellScript(Command):
         self.success_ret_code: set[int] = success_ret_code or {0}
         # self.piped_cmds: Optional[Command] = None
         self._modified_script: Optional[str] = None
+        # pre-split around the placeholder, such that each replacement is a single join
+        self._template_parts = script.split("{}")
 
     def get_script(self) -> str:
         if self._modified_script:
@@ -92,6 +105,13 @@ class ShellScript(Command):
         ret_code, output, stderr = await command_runner_stream_with_output(split_script_as_shell(self.get_script()))
         return self.check_ret_code(ret_code), output, stderr
 
+    async def run_streaming(self, on_line: Callable[[str], Any]) -> CommandResult:
+        """
+        Stream the output lines as soon as they are produced.
+        """
+        ret_code, stderr = await command_runner_stream_lines(split_script_as_shell(self.get_script()), on_line)
+        return self.check_ret_code(ret_code), "", stderr
+
     def check_ret_code(self, retcode: int) -> bool:
         """
         Check if the return code is in the success return code set.
@@ -99,10 +119,12 @@ class ShellScript(Command):
         return retcode in self.success_ret_code
 
     def with_replacement_part(self, part: str) -> "Command":
-        if "{}" not in self.script:
+        if len(self._template_parts) < 2:
             raise ValueError("Script must contain '{}' placeholder for replacement part.")
-        self._modified_script = self.script.replace("{}", part)
-        return self
+        # return a modified copy, such that the same command can be safely shared
+        replaced = copy.copy(self)
+        replaced._modified_script = part.join(self._template_parts)
+        return replaced
 
 
 class PipedCommand(ShellScript):
@@ -117,6 +139,10 @@ class PipedCommand(ShellScript):
     async def run(self) -> bool:
         return (await self.run_with_output())[0]
 
+    async def run_streaming(self, on_line: Callable[[str], Any]) -> CommandResult:
+        # only the final output of the pipe is available
+        return await Command.run_streaming(self, on_line)
+
     async def run_with_output(self) -> CommandResult:
         import asyncio
 
@@ -1,11 +1,19 @@
 import asyncio
+import contextvars
+import hashlib
+import json
+import mmap
 import os
+import pickle
+import sys
+import tempfile
 import tomllib
 from typing import Any, Callable, Dict, Iterable, Literal, Optional
 import importlib.util
 
 from pathlib import Path
 from dataclasses import dataclass, field
+
 from . import printer
 from .helpers import ExitSignal, UserSelectOption, async_all, santise_variable_name
 from .command import (
@@ -18,6 +26,8 @@ from .command import (
 )
 from .printer import (
     ASK_USER,
+    INFO,
+    aDEBUG,
     aERROR_EXIT,
     aINFO,
     GREEN,
@@ -31,10 +41,27 @@ from .registry import (
     USER_EXPORT,
 )
 
+try:
+    # optional, much faster C-backed toml parser
+    import rtoml  # type: ignore[import-not-found]
+
+    def _load_toml(f) -> dict[str, Any]:
+        return rtoml.loads(f.read().decode())
+
+except ImportError:
+
+    def _load_toml(f) -> dict[str, Any]:
+        return tomllib.load(f)
+
+
 DEFAULT_SAVE_OUTPUT_FILE = "99.unsorted.py"
 
 
 OPERATION_LOCK = asyncio.Lock()
+# max number of concurrent `extract_add_cmd_part` subprocesses when listing packages
+EXTRACT_CONCURRENCY = 32
+# max number of package managers being processed concurrently
+MANAGER_CONCURRENCY = os.cpu_count() or 1
 
 
 @dataclass
@@ -46,7 +73,7 @@ class CLIOptions:
     sync: bool
 
 
-@dataclass
+@dataclass(slots=True)
 class PackageManager:
     """
     A simple package manager class that uses shell commands to install and remove packages.
@@ -65,7 +92,7 @@ class PackageManager:
         # collect all the install commands, depending on
         # if the package manager supports multiple installs in one command
         if self.supports_multi_pkgs:
-            add_cmd_parts = [" ".join(pkg.get_add_cmd_part() for pkg in packages)]
+            add_cmd_parts = [" ".join([pkg.get_add_cmd_part() for pkg in packages])]
         else:
             add_cmd_parts = [pkg.get_add_cmd_part() for pkg in packages]
 
@@ -78,7 +105,7 @@ class PackageManager:
         # collect all the remove commands, depending on
         # if the package manager supports multiple removes in one command
         if self.supports_multi_pkgs:
-            remove_cmd_parts = [" ".join(pkg.name for pkg in package)]
+            remove_cmd_parts = [" ".join([pkg.name for pkg in package])]
         else:
             remove_cmd_parts = [pkg.name for pkg in package]
 
@@ -88,47 +115,100 @@ class PackageManager:
         )
 
     async def list_installed(self) -> list[Package]:
-        success, stdout, stderr = await self.list_cmd.run_with_output()
-        if not success:
-            await aERROR_EXIT(f"Failed to list installed packages: {stderr}")
-        if isinstance(stdout, str):
-            pkgs_str = stdout.splitlines()
-            # if this command supports transforming pkg to add_cmd_part, do it
-            # this normally enrich the package info from cli output
-
-            if isinstance(self.extract_add_cmd_part, UndefinedCommand):
-                pkgs = [Package(pkg) for pkg in pkgs_str]
+        # if this command supports transforming pkg to add_cmd_part, do it
+        # this normally enrich the package info from cli output
+        needs_extract = not isinstance(self.extract_add_cmd_part, UndefinedCommand)
+        # bound the number of subprocesses spawned at once
+        semaphore = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+        extract_tasks: list[asyncio.Task[Package]] = []
+        pkgs: list[Package] = []
+        # lines are received within the output stream's context, run the extraction in ours instead
+        context = contextvars.copy_context()
+
+        async def extract(pkg_str: str) -> Package:
+            async with semaphore:
+                ok, part, stderr = await self.extract_add_cmd_part.with_replacement_part(pkg_str).run_with_output()
+            if not ok:
+                raise ValueError(f"Error when processing for '{pkg_str}': {stderr}")
+            return Package(pkg_str, add_cmd_part=part.strip())
+
+        def on_line(pkg_str: str):
+            # start processing each package while the listing is still running
+            if needs_extract:
+                extract_tasks.append(context.run(asyncio.create_task, extract(pkg_str)))
             else:
-                pkgs = []
-                for pkg_str in pkgs_str:
-                    ok, part, stderr = await self.extract_add_cmd_part.with_replacement_part(pkg_str).run_with_output()
-                    if not ok:
-                        raise ValueError(f"Error when processing for '{pkg_str}': {stderr}")
-                    pkgs.append(Package(pkg_str, add_cmd_part=part.strip()))
+                pkgs.append(Package(pkg_str))
 
-            return pkgs
-        return stdout
+        try:
+            success, stdout, stderr = await self.list_cmd.run_streaming(on_line)
+            if not success:
+                await aERROR_EXIT(f"Failed to list installed packages: {stderr}")
+            if not isinstance(stdout, str):
+                return stdout
+            if extract_tasks:
+                pkgs = list(await asyncio.gather(*extract_tasks))
+        except BaseException:
+            # on any failure, stop the remaining extractions and wait for them to wind down,
+            # such that none is left running (or unretrieved) when the error propagates
+            for task in extract_tasks:
+                task.cancel()
+            await asyncio.gather(*extract_tasks, return_exceptions=True)
+            raise
+        return pkgs
 
 
 async def load_user_configs(config_dir: Path) -> None:
     """
     Load user configs from the config directory.
     """
+
+    def source_all(files: list[Path]):
+        # configs may depend on the state declared by earlier files, so they are
+        # executed in order within a single worker thread
+        for file in files:
+            # name the module by its absolute path, such that files with the same name in
+            # different directories do not collide, and already sourced files are reused
+            path_hash = hashlib.md5(str(file.resolve()).encode(), usedforsecurity=False).hexdigest()
+            mod_name = f"pkgmgr_userconfig_{path_hash}"
+            if mod_name in sys.modules:
+                continue
+            INFO(f"Sourcing '{file}'...")
+            spec = importlib.util.spec_from_file_location(mod_name, file)
+            if spec is None or spec.loader is None:
+                raise ImportError(f"Cannot load config file '{file}'")
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[mod_name] = module
+            try:
+                spec.loader.exec_module(module)
+            except BaseException:
+                del sys.modules[mod_name]
+                raise
+
     # import all .py file in the config directory
     with printer.PKG_CTX("pkg-state"):
-        for file in sorted(config_dir.glob("*.py")):
-            await aINFO(f"Sourcing '{file}'...")
-            spec = importlib.util.spec_from_file_location(file.name, file)
-            assert spec is not None
-            module = importlib.util.module_from_spec(spec)
-            assert spec.loader is not None
-            spec.loader.exec_module(module)
+        # run the blocking imports off the event loop
+        await asyncio.to_thread(source_all, sorted(config_dir.glob("*.py")))
+
+
+# commands are immutable, so identical config fragments can share the same instance
+_CMD_CACHE: dict[str, Command] = {}
 
 
 async def load_command(
     cmd,
     key: str,
     mgr_name: str,
+) -> Command:
+    cache_key = json.dumps(cmd, sort_keys=True, default=repr)
+    if cache_key not in _CMD_CACHE:
+        _CMD_CACHE[cache_key] = await _build_command(cmd, key, mgr_name)
+    return _CMD_CACHE[cache_key]
+
+
+async def _build_command(
+    cmd,
+    key: str,
+    mgr_name: str,
 ) -> Command:
     if isinstance(cmd, str):
         return ShellScript(cmd)
@@ -159,6 +239,55 @@ async def load_command(
     assert False, "Unreachable code"
 
 
+def get_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pkgmgr")
+
+
+def load_toml_cached(path: Path) -> dict[str, Any]:
+    """
+    Load a toml file, re-using the parsed result from previous runs if the file has not changed.
+    The cache is keyed on the file's mtime and size.
+    """
+    path = path.resolve()
+    stat = path.stat()
+    key = (stat.st_mtime_ns, stat.st_size)
+    cache_file = get_cache_dir() / f"{hashlib.md5(str(path).encode(), usedforsecurity=False).hexdigest()}.pkl"
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, config = pickle.load(f)
+        if cached_key == key:
+            return config
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        # cache missing or corrupted, re-parse
+        pass
+
+    with open(path, "rb") as f:
+        config = _load_toml(f)
+
+    try:
+        # the cache is unpickled on load, so keep it private to the user
+        cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # write to a temporary file first, such that concurrent runs never see a partially written cache
+        with tempfile.NamedTemporaryFile("wb", dir=cache_file.parent, suffix=".tmp", delete=False) as tmp:
+            try:
+                pickle.dump((key, config), tmp)
+                tmp.close()
+                os.replace(tmp.name, cache_file)
+            except BaseException:
+                # do not leave the temporary file behind on any failure
+                tmp.close()
+                try:
+                    os.unlink(tmp.name)
+                except OSError:
+                    pass
+                raise
+    except (OSError, pickle.PicklingError):
+        # caching is best-effort only
+        pass
+    return config
+
+
 async def load_mgr_config(config_dir: Path, requested_mgrs: Iterable[str]) -> dict[str, PackageManager]:
     """
     Load package manager config from the config directory.
@@ -168,13 +297,11 @@ async def load_mgr_config(config_dir: Path, requested_mgrs: Iterable[str]) -> di
     if not pkg_mgr_config.is_file():
         await aERROR_EXIT(f"Config file '{pkg_mgr_config}' does not exist.")
 
-    with open(pkg_mgr_config, "rb") as f:
-        config = tomllib.load(f)
-
-        try:
-            managers_conf = config["manager"]
-        except KeyError:
-            await aERROR_EXIT("No package managers found in config.toml")
+    config = load_toml_cached(pkg_mgr_config)
+    try:
+        managers_conf = config["manager"]
+    except KeyError:
+        await aERROR_EXIT("No package managers found in config.toml")
 
     mgrs_def: dict[str, PackageManager] = {}
     for mgr_name, mgr_config in managers_conf.items():
@@ -204,21 +331,22 @@ async def load_mgr_config(config_dir: Path, requested_mgrs: Iterable[str]) -> di
         if mgr_name not in mgrs_def:
             await aERROR_EXIT(f"Manager for '{mgr_name}' not found in {pkg_mgr_config}")
 
-    return dict(filter(lambda x: not x[1].disabled, mgrs_def.items()))
+    return {name: mgr for name, mgr in mgrs_def.items() if not mgr.disabled}
 
 
 async def load_all(config_dir: Path = Path("./configs")):
     if not config_dir.is_dir():
         await aERROR_EXIT(f"Config directory '{config_dir}' does not exist.")
 
-    with printer.PKG_CTX:
-        with printer.PKG_CTX("load-conf"):
-            await aINFO(f"Collecting desire package state in '{config_dir}/'...")
-            await load_user_configs(config_dir)
+    with printer.PKG_CTX("load-conf"):
+        await aINFO(f"Collecting desire package state in '{config_dir}/'...")
+        await load_user_configs(config_dir)
 
-            await aINFO(f"Loading manager definition at '{config_dir / 'pkgmgr.toml'}'...")
-            managers = await load_mgr_config(config_dir, REQUESTED_MANAGERS.data_pair.keys())
-        return managers
+        await aINFO(f"Loading manager definition at '{config_dir / 'pkgmgr.toml'}'...")
+        # snapshot, rather than a live view of the registry
+        requested = tuple(REQUESTED_MANAGERS.data_pair)
+        managers = await load_mgr_config(config_dir, requested)
+    return managers
 
 
 async def collect_state(
@@ -230,23 +358,73 @@ async def collect_state(
     await aINFO("Checking packages state...")
 
     want_installed = requested_state.pkgs
-    currently_installed_packages = set(await pkg_mgr.list_installed())
+    currently_installed_packages = {pkg.name: pkg for pkg in await pkg_mgr.list_installed()}
 
     #######################################################
 
-    pkgs_wanted = set()
-    for package in want_installed:
-        if package not in currently_installed_packages:
-            pkgs_wanted.add(package)
+    # packages are compared by name, so diff the name keys directly without hashing any Package
+    pkgs_wanted = want_installed.keys() - currently_installed_packages.keys()
 
     #######################################################
 
-    pkgs_not_recorded = currently_installed_packages - set(want_installed) - requested_state.ignore_pkgs
+    pkgs_not_recorded = currently_installed_packages.keys() - want_installed.keys()
+    pkgs_not_recorded -= requested_state.ignore_pkgs
 
+    wanted_names: Iterable[str] = pkgs_wanted
+    not_recorded_names: Iterable[str] = pkgs_not_recorded
     if sort:
-        return sorted(pkgs_wanted), sorted(pkgs_not_recorded)
+        # packages are ordered by name, so sorting the plain names gives the same order
+        wanted_names, not_recorded_names = sorted(pkgs_wanted), sorted(pkgs_not_recorded)
+    want_list = [want_installed[name] for name in wanted_names]
+    not_recorded_list = [currently_installed_packages[name] for name in not_recorded_names]
+
+    return want_list, not_recorded_list
 
-    return list(pkgs_wanted), list(pkgs_not_recorded)
+
+async def collect_all_states(
+    managers: dict[str, PackageManager],
+    target: Optional[str] = None,
+    use_sync: bool = False,
+    skip_failed: bool = False,
+    skip_if_empty: bool = False,
+) -> dict[str, tuple[list[Package], list[Package]]]:
+    """
+    Collect the state of every (targeted) package manager up front.
+    Listing installed packages is subprocess-bound, so all managers are queried concurrently
+    before any user interaction happens.
+    If skip_failed is set, managers that fail to list their packages are left out of the result.
+    If skip_if_empty is set, managers without any declared state are not queried at all, and are also
+    left out of the result. An explicitly targeted manager is never skipped.
+    """
+    states: dict[str, tuple[list[Package], list[Package]]] = {}
+
+    semaphore = asyncio.Semaphore(MANAGER_CONCURRENCY)
+
+    async def inner(name: str, pkg_mgr: PackageManager, requested_state: DeclaredPackageState):
+        if skip_if_empty and target is None and not requested_state.pkgs and not requested_state.ignore_pkgs:
+            await aDEBUG("No declared packages, skipping.")
+            return
+        try:
+            async with semaphore:
+                states[name] = await collect_state(requested_state, pkg_mgr)
+        except ExitSignal:
+            if not skip_failed:
+                raise
+
+    tasks = []
+    for name, pkg_mgr, requested_state in for_each_registered_mgr(managers):
+        if target is not None and name != target:
+            continue
+        if use_sync:
+            await inner(name, pkg_mgr, requested_state)
+        else:
+            # the task copies the current context, i.e., the manager's PKG_CTX
+            tasks.append(asyncio.create_task(inner(name, pkg_mgr, requested_state)))
+    # let every collection finish before raising, such that no task is left running on failure
+    for error in await asyncio.gather(*tasks, return_exceptions=True):
+        if error is not None:
+            raise error
+    return states
 
 
 async def save_wanted_pkgs_to_file(
@@ -254,24 +432,29 @@ async def save_wanted_pkgs_to_file(
 ):
     IDEN_var_name = santise_variable_name(pkg_mgr_name)
 
-    file.write("\n" + "#" * 25 + "\n")
-    file.write(f"# {pkg_mgr_name}\n")
-    file.write("#" * 25 + "\n")
-
-    file.write(f'\n{IDEN_var_name} = MANAGERS["{IDEN_var_name}"]\n')
+    # collect everything first, such that the section is written with a single write
+    parts = [
+        "\n" + "#" * 25 + "\n",
+        f"# {pkg_mgr_name}\n",
+        "#" * 25 + "\n",
+        f'\n{IDEN_var_name} = MANAGERS["{IDEN_var_name}"]\n',
+    ]
 
     # invert to bring the config up-to-speed
 
     if pkgs_not_recorded:
-        file.write("\n# wanted\n")
-        for pkg_name in pkgs_not_recorded:
-            file.write(f"{IDEN_var_name} << {pkg_name.get_config_repr()}\n")
-            await aINFO(f"Added {pkg_name}")
+        parts.append("\n# wanted\n")
+        parts.extend([f"{IDEN_var_name} << {pkg_name.get_config_repr()}\n" for pkg_name in pkgs_not_recorded])
     if pkgs_wanted:
-        file.write("\n# unwanted\n")
-        for pkg in pkgs_wanted:
-            file.write(f"{IDEN_var_name} >> {pkg.name!r}\n")
-            await aINFO(f"To remove {pkg!r}")
+        parts.append("\n# unwanted\n")
+        parts.extend([f"{IDEN_var_name} >> {pkg.name!r}\n" for pkg in pkgs_wanted])
+    file.write("".join(parts))
+
+    # logging only queues the output, so there is nothing to gain from running these concurrently
+    for pkg_name in pkgs_not_recorded:
+        await aINFO(f"Added {pkg_name}")
+    for pkg in pkgs_wanted:
+        await aINFO(f"To remove {pkg!r}")
 
 
 def for_each_registered_mgr(managers: dict[str, PackageManager]):
@@ -294,15 +477,17 @@ async def cmd_save(args: CLIOptions, managers: dict[str, PackageManager], target
                 "Please organise your packages definition in the config directory first. [use -f to force]"
             )
 
+    # perhaps some manager uses binary that does not exists, skip those.
+    # all managers are listed regardless of their declared state, to discover packages
+    states = await collect_all_states(managers, target, args.sync, skip_failed=True)
+
     # since this is async, not thread, we can safely use a list to store result.
     packages_to_write = []
 
     async def inner_save(name: str, pkg_mgr: PackageManager, requested_state: DeclaredPackageState):
-        try:
-            pkgs_wanted, pkgs_not_recorded = await collect_state(requested_state, pkg_mgr)
-        except ExitSignal:
-            # perhaps this package uses binary that does not exists
+        if name not in states:
             return
+        pkgs_wanted, pkgs_not_recorded = states[name]
 
         if pkgs_wanted or pkgs_not_recorded:
             if not pkg_mgr.supports_save:
@@ -364,10 +549,10 @@ async def cmd_save(args: CLIOptions, managers: dict[str, PackageManager], target
             file_path = args.config_dir / DEFAULT_SAVE_OUTPUT_FILE
             needs_import = True
 
-            if file_path.exists():
-                with open(file_path, "r", encoding="utf-8") as f:
-                    if import_line in f.read():
-                        needs_import = False
+            # search the file in-place instead of reading it all into memory
+            if file_path.exists() and file_path.stat().st_size >= len(import_line):
+                with open(file_path, "rb") as existing, mmap.mmap(existing.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    needs_import = mm.find(import_line.encode()) == -1
 
             with open(file_path, "a", encoding="utf-8") as f:
                 if needs_import:
@@ -377,8 +562,14 @@ async def cmd_save(args: CLIOptions, managers: dict[str, PackageManager], target
 
 
 async def cmd_apply(args: CLIOptions, managers: dict[str, PackageManager], target: Optional[str] = None) -> None:
+    # a manager without any declared packages is not managed by the user
+    states = await collect_all_states(managers, target, args.sync, skip_if_empty=True)
+
     async def inner_apply(name: str, pkg_mgr: PackageManager, requested_state: DeclaredPackageState):
-        pkgs_wanted, pkgs_not_recorded = await collect_state(requested_state, pkg_mgr)
+        if name not in states:
+            await aINFO("No packages declared, skipped.")
+            return
+        pkgs_wanted, pkgs_not_recorded = states[name]
 
         if pkgs_wanted or pkgs_not_recorded:
             await aINFO("The following changes to packages are detected:")
@@ -457,8 +648,14 @@ async def cmd_apply(args: CLIOptions, managers: dict[str, PackageManager], targe
 
 
 async def cmd_diff(args: CLIOptions, managers: dict[str, PackageManager], target: Optional[str] = None) -> None:
+    # a manager without any declared packages is not managed by the user
+    states = await collect_all_states(managers, target, args.sync, skip_if_empty=True)
+
     async def inner_diff(name, pkg_mgr, requested_state):
-        pkgs_wanted, pkgs_not_recorded = await collect_state(requested_state, pkg_mgr)
+        if name not in states:
+            await aINFO("No packages declared, skipped.")
+            return
+        pkgs_wanted, pkgs_not_recorded = states[name]
 
         if pkgs_wanted or pkgs_not_recorded:
             await aINFO("Diff of current system against the configs:")
@@ -489,17 +686,17 @@ async def apply_on_each_pkg(
     A helper function to apply a function on each package manager.
     """
 
+    semaphore = asyncio.Semaphore(MANAGER_CONCURRENCY)
+
     async def wrapper(name, pkg_mgr, requested_state):
         # this wrapper enable the context manager to be used
         # in the async function
-        with printer.PKG_CTX(name):
-            return await functor(name, pkg_mgr, requested_state)
+        async with semaphore:
+            with printer.PKG_CTX(name):
+                return await functor(name, pkg_mgr, requested_state)
 
-    registered_mgr = for_each_registered_mgr(managers)
     if target is not None and target not in managers:
-        registered_mgr = list(filter(lambda x: x[0] == target, registered_mgr))
-        if len(registered_mgr) == 0:
-            await aERROR_EXIT(f"Target '{target}' not found in registered managers.")
+        await aERROR_EXIT(f"Target '{target}' not found in registered managers.")
 
     tasks = []
     for name, pkg_mgr, requested_state in for_each_registered_mgr(managers):
@@ -512,5 +709,6 @@ async def apply_on_each_pkg(
             tasks.append(wrapper(name, pkg_mgr, requested_state))
 
     # the taks returns nothing. if it did, those would be exception.
-    for error in filter(None, await asyncio.gather(*tasks, return_exceptions=True)):
-        raise error
+    for error in await asyncio.gather(*tasks, return_exceptions=True):
+        if error is not None:
+            raise error
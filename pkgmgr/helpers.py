@@ -5,7 +5,7 @@ import os
 import re
 import shlex
 import sys
-from typing import Any, Awaitable, Callable, Generic, TypeVar
+from typing import Any, Awaitable, Callable, Generic, Optional, TypeVar
 
 
 async def async_all(async_iterable: AsyncIterable[object]) -> bool:
@@ -33,18 +33,78 @@ class UserSelectOption(Generic[T]):
     data: T
 
 
+_SANITISE_RE = re.compile(r"\W|^(?=\d)")
+
+
 def santise_variable_name(var_str: str):
     """
     Sanitise a variable name by replacing non-alphanumeric characters with underscores.
     """
-    return re.sub("\W|^(?=\d)", "_", var_str)
+    return _SANITISE_RE.sub("_", var_str)
+
+
+# input that was read from stdin but not consumed yet, e.g. type-ahead of the next answers.
+# stdin is read from the raw fd, as the buffered sys.stdin would hide these from the readiness check
+_STDIN_BUFFER = bytearray()
+
+
+def _pop_stdin_line(at_eof: bool = False) -> Optional[str]:
+    """
+    Take the next complete line from the stdin buffer, or everything that is left at EOF.
+    """
+    end = _STDIN_BUFFER.find(b"\n") + 1
+    if not end:
+        if not at_eof:
+            return None
+        end = len(_STDIN_BUFFER)
+    line = bytes(_STDIN_BUFFER[:end])
+    del _STDIN_BUFFER[:end]
+    return line.decode(sys.stdin.encoding or "utf-8", errors="replace")
 
 
 async def async_input_non_blocking(prompt="> "):
     """This is needed as asyncio does not support non-blocking input natively."""
-    reader = await connect_stdin_stdout()
     print(prompt, end="", flush=True)
-    return (await reader.readline()).decode().strip()
+    # a previous read may already contain this answer
+    line = _pop_stdin_line()
+    if line is not None:
+        return line.strip()
+
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    future: asyncio.Future[str] = loop.create_future()
+
+    def on_readable():
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            # spurious wakeup, keep waiting
+            return
+        except OSError as e:
+            # e.g. the terminal hung up, fail the prompt rather than leaving it waiting forever
+            loop.remove_reader(fd)
+            if not future.done():
+                future.set_exception(e)
+            return
+        _STDIN_BUFFER.extend(data)
+        line = _pop_stdin_line(at_eof=not data)
+        if line is not None:
+            loop.remove_reader(fd)
+            if not future.done():
+                future.set_result(line)
+
+    try:
+        # wait for stdin to become readable within the event loop itself
+        loop.add_reader(fd, on_readable)
+    except NotImplementedError:
+        # e.g. the proactor event loop on Windows does not support readers
+        return (await loop.run_in_executor(None, sys.stdin.readline)).strip()
+
+    try:
+        return (await future).strip()
+    finally:
+        # also stop watching stdin when cancelled
+        loop.remove_reader(fd)
 
 
 async def connect_stdin_stdout():
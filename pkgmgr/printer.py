@@ -1,34 +1,58 @@
-import re
 import sys
+import atexit
 import asyncio
+import threading
 
-from enum import Enum
-from contextvars import ContextVar
+from enum import IntEnum
+from contextvars import ContextVar, Token
+from typing import Callable, Optional, TextIO, Union
 
 from .helpers import ExitSignal, UserSelectOption, async_input_non_blocking, T
 
 
-PRINT_LOCK = asyncio.Lock()
+# serialises concurrent user prompts, printing only goes through the output queue below.
+# created lazily, as it is only needed for interactive commands and is bound to the running loop
+_INPUT_LOCK: Optional[asyncio.Lock] = None
+_INPUT_LOCK_LOOP: Optional[asyncio.AbstractEventLoop] = None
 
+# escape codes are useless bytes when the output is not a terminal (e.g. piped to a log file)
+_USE_COLOR = hasattr(sys.stdout, "isatty") and sys.stdout.isatty()
 
-GREEN = "\033[92m"
-RED = "\033[91m"
-BLUE = "\033[33m"
-PINK = "\033[95m"
-CYAN = "\033[96m"
-GREY = "\033[90m"
-BROWN = "\033[0;33m"
-BLUE = "\033[0;34m"
-PURPLE = "\033[0;35m"
-LIGHT_BLUE = "\033[0;36m"
-LIGHT_GRAY = "\033[0;37m"
-END = "\033[0m"
+
+def _c(code: str) -> str:
+    return code if _USE_COLOR else ""
+
+
+GREEN = _c("\033[92m")
+RED = _c("\033[91m")
+BLUE = _c("\033[33m")
+PINK = _c("\033[95m")
+CYAN = _c("\033[96m")
+GREY = _c("\033[90m")
+BROWN = _c("\033[0;33m")
+BLUE = _c("\033[0;34m")
+PURPLE = _c("\033[0;35m")
+LIGHT_BLUE = _c("\033[0;36m")
+LIGHT_GRAY = _c("\033[0;37m")
+END = _c("\033[0m")
 NORMAL = END
-UNDERLINE = "\033[4m"
-BOLD = "\033[1m"
+UNDERLINE = _c("\033[4m")
+BOLD = _c("\033[1m")
 
 NEEDS_PREFIX = True
 
+# a message, or a callable that produces the message only when it is going to be printed
+LazyText = Union[str, Callable[[], str]]
+
+# output that is pending to be written, as (stream, prefix, text, needs_prefix_after).
+# this is only written by `flush_output`, which is scheduled at most once per event loop iteration
+_PENDING_OUTPUT: list[tuple[TextIO, str, str, bool]] = []
+# configs are sourced in a worker thread, which prints (and flushes) alongside the event loop
+_OUTPUT_LOCK = threading.Lock()
+_FLUSH_SCHEDULED = False
+# while held (e.g. when waiting for user input), output is only queued
+_OUTPUT_HELD = False
+
 
 class PackageContext:
     """
@@ -38,37 +62,45 @@ class PackageContext:
 
     def __init__(self):
         self.current_pkg: ContextVar = ContextVar("current_pkg", default=None)
-        self.current_pkg_tokens = []
 
-        # self.current_pkg: Optional[str] = None
-        # self.stack_depth: int = 0
-
-    def __call__(self, pkg_name: str):
-        prefix = self.current_pkg.get()
-        if prefix is not None:
-            prefix = f"{prefix}:{pkg_name}"
-        else:
-            prefix = pkg_name
-        self.current_pkg.set(prefix)
+    def __call__(self, pkg_name: str) -> "PackageScope":
+        return PackageScope(self, pkg_name)
 
+    def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # using the context without a package name does not modify the context
+        pass
+
+
+class PackageScope:
+    """
+    A single package scope within the package context.
+    Each scope keeps the token of its own change, so exiting restores the exact parent context.
+    """
+
+    def __init__(self, pkg_ctx: PackageContext, pkg_name: str):
+        self.pkg_ctx = pkg_ctx
+        self.pkg_name = pkg_name
+        self._token: Optional[Token] = None
+
     def __enter__(self):
-        # self.stack_depth += 1
+        prefix = self.pkg_ctx.current_pkg.get()
+        if prefix is not None:
+            prefix = f"{prefix}:{self.pkg_name}"
+        else:
+            prefix = self.pkg_name
+        self._token = self.pkg_ctx.current_pkg.set(prefix)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # self.stack_depth -= 1
-        prefix = self.current_pkg.get()
-        if prefix is not None:
-            prefix = prefix.split(":")
-            if len(prefix) > 1:
-                self.current_pkg.set(":".join(prefix[:-1]))
-            else:
-                self.current_pkg.set(None)
+        assert self._token is not None
+        self.pkg_ctx.current_pkg.reset(self._token)
+        self._token = None
 
 
-class Verbosity(Enum):
+class Verbosity(IntEnum):
     """
     Enum for verbosity levels.
     """
@@ -81,35 +113,135 @@ class Verbosity(Enum):
 
 
 PKG_CTX = PackageContext()
-VERBOSITY_CTX = ContextVar("verbosity", default=Verbosity.INFO)
+# Verbosity is an IntEnum, so levels compare as plain ints on every print
+VERBOSITY_CTX: ContextVar[Verbosity] = ContextVar("verbosity", default=Verbosity.INFO)
+
+
+def set_verbosity(level: Verbosity):
+    VERBOSITY_CTX.set(level)
+
+
+_NO_PKG_PREFIX = f"{GREY}:: "
+# there are only a handful of distinct package contexts, so their prefixes are formatted once
+_PKG_PREFIX_CACHE: dict[str, str] = {}
+
+
+def get_prefix() -> str:
+    pkg = PKG_CTX.current_pkg.get()
+    if not pkg:
+        return _NO_PKG_PREFIX
+    prefix = _PKG_PREFIX_CACHE.get(pkg)
+    if prefix is None:
+        prefix = _PKG_PREFIX_CACHE[pkg] = f"{GREY}:: {BROWN}[{pkg}] "
+    return prefix
 
 
-def print_prefix(**kw):
+def print_prefix(file: Optional[TextIO] = None):
     """
-    Assumes the print lock is already acquired.
+    Assumes the pending output had been flushed.
     """
     global NEEDS_PREFIX
 
-    pkg = PKG_CTX.current_pkg.get()
-    pkg_txt = f"{BROWN}[{pkg}] " if pkg else ""
-    print(f"{GREY}:: {pkg_txt}", **kw, end="")
-    sys.stdout.flush()
+    (file or sys.stdout).write(get_prefix())
     NEEDS_PREFIX = False
 
 
-async def amy_print(*args, **kwargs):
-    async with PRINT_LOCK:
-        my_print(*args, **kwargs)
+def _write_out(stream: TextIO, parts: list[str]):
+    stream.write("".join(parts))
+    stream.flush()
 
 
-def my_print(text: str, color: str, end="\n", msg_level: Verbosity = Verbosity.INFO, **kw):
-    if VERBOSITY_CTX.get().value < msg_level.value:
+def flush_output():
+    """
+    Write out all pending output, with one write per run of output to the same stream.
+    The prefix of each output is only emitted if the previous output had ended its line.
+    """
+    global NEEDS_PREFIX, _FLUSH_SCHEDULED
+    with _OUTPUT_LOCK:
+        _FLUSH_SCHEDULED = False
+        if _OUTPUT_HELD or not _PENDING_OUTPUT:
+            return
+
+        stream: Optional[TextIO] = None
+        parts: list[str] = []
+        for target, prefix, text, needs_prefix_after in _PENDING_OUTPUT:
+            if target is not stream:
+                if stream is not None:
+                    _write_out(stream, parts)
+                    parts = []
+                stream = target
+            if NEEDS_PREFIX:
+                parts.append(prefix)
+            parts.append(text)
+            NEEDS_PREFIX = needs_prefix_after
+        _PENDING_OUTPUT.clear()
+        if stream is not None:
+            _write_out(stream, parts)
+
+
+# do not lose pending output if the event loop stops before flushing it
+atexit.register(flush_output)
+
+
+def _queue_output(stream: TextIO, prefix: str, text: str, needs_prefix_after: bool):
+    with _OUTPUT_LOCK:
+        _PENDING_OUTPUT.append((stream, prefix, text, needs_prefix_after))
+
+
+def _schedule_flush():
+    global _FLUSH_SCHEDULED
+    if not _FLUSH_SCHEDULED:
+        _FLUSH_SCHEDULED = True
+        asyncio.get_running_loop().call_soon(flush_output)
+
+
+def write_raw(text: str):
+    """
+    Queue raw output (e.g. from a subprocess) to stdout. A prefix is added at the start of each line.
+    Must be called within the event loop.
+    """
+    _queue_output(sys.stdout, get_prefix(), text, text.endswith("\n"))
+    _schedule_flush()
+
+
+def level_enabled(level: Verbosity) -> bool:
+    """
+    Check if messages of the given level are printed at the current verbosity.
+    """
+    return VERBOSITY_CTX.get() >= level
+
+
+async def amy_print(text: LazyText, color: str, end="\n", msg_level: Verbosity = Verbosity.INFO, file=None):
+    # filter out suppressed messages before formatting anything
+    if VERBOSITY_CTX.get() < msg_level:
         return
-    global NEEDS_PREFIX
-    if NEEDS_PREFIX:
-        print_prefix()
-    print(f"{color}{text}{END}", **kw, end=end)
-    NEEDS_PREFIX = True
+    if callable(text):
+        text = text()
+    # no locking needed, the output is written out in order once the current task yields
+    _queue_output(file or sys.stdout, get_prefix(), f"{color}{text}{END}{end}", True)
+    _schedule_flush()
+
+
+def my_print(text: LazyText, color: str, end="\n", msg_level: Verbosity = Verbosity.INFO, file=None):
+    """
+    Print the text if the verbosity permits.
+    The text can be a callable returning the text, such that costly messages are only formatted
+    when they are actually printed, e.g. `DEBUG(lambda: f"...")`.
+    """
+    if VERBOSITY_CTX.get() < msg_level:
+        return
+    if callable(text):
+        text = text()
+    # goes through the pending output to stay in order with queued async output
+    _queue_output(file or sys.stdout, get_prefix(), f"{color}{text}{END}{end}", True)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # no event loop (e.g. sourcing configs in a worker thread) that would flush it later
+        flush_output()
+    else:
+        # batched together with the rest of the output of this loop iteration
+        _schedule_flush()
 
 
 async def TERM_STDOUT(text: str, **kw):
@@ -120,27 +252,27 @@ async def TERM_STDERR(text: str, **kw):
     await amy_print(text, PINK, **kw, file=sys.stderr)
 
 
-async def aINFO(text: str, color=CYAN):
+async def aINFO(text: LazyText, color=CYAN):
     await amy_print(text, color, msg_level=Verbosity.INFO)
 
 
-def INFO(text: str, color=CYAN):
+def INFO(text: LazyText, color=CYAN):
     my_print(text, color, msg_level=Verbosity.INFO)
 
 
-async def aWARN(text: str, color=PINK):
+async def aWARN(text: LazyText, color=PINK):
     await amy_print(text, color, msg_level=Verbosity.WARN)
 
 
-async def aDEBUG(text: str, color=GREY):
+async def aDEBUG(text: LazyText, color=GREY):
     await amy_print(text, color, msg_level=Verbosity.DEBUG)
 
 
-def WARN(text: str, color=PINK):
+def WARN(text: LazyText, color=PINK):
     my_print(text, color, msg_level=Verbosity.WARN)
 
 
-async def aERROR(text: str):
+async def aERROR(text: LazyText):
     await amy_print(text, RED, file=sys.stderr, msg_level=Verbosity.ERROR)
 
 
@@ -149,6 +281,20 @@ async def aERROR_EXIT(*args, **kw):
     raise ExitSignal()
 
 
+def _get_input_lock() -> asyncio.Lock:
+    global _INPUT_LOCK, _INPUT_LOCK_LOOP
+    loop = asyncio.get_running_loop()
+    if _INPUT_LOCK is None or _INPUT_LOCK_LOOP is not loop:
+        _INPUT_LOCK, _INPUT_LOCK_LOOP = asyncio.Lock(), loop
+    return _INPUT_LOCK
+
+
+_PROMPT_START = f"{PURPLE}{BOLD}> {UNDERLINE}"
+
+# commas are treated as whitespace when parsing indices
+_INDEX_SEP_TRANS = str.maketrans(",", " ")
+
+
 async def parse_indices(index_str: str, max_value: int, min_value: int = 1) -> list[int]:
     """
     Parse a string of indices into a list of integers.
@@ -163,7 +309,8 @@ async def parse_indices(index_str: str, max_value: int, min_value: int = 1) -> l
         raise ValueError("max_value must be greater than or equal to min_value")
 
     result = set()
-    tokens = re.split(r"[,\s]+", index_str.strip())
+    # split() without argument already splits on (runs of) any whitespace, and drops empty tokens
+    tokens = index_str.translate(_INDEX_SEP_TRANS).split()
 
     for token in tokens:
         if "-" in token:
@@ -177,7 +324,7 @@ async def parse_indices(index_str: str, max_value: int, min_value: int = 1) -> l
                     result.add(i)
             except ValueError:
                 await aERROR(f"Invalid range format: '{token}'")
-        elif token:
+        else:
             try:
                 i = int(token)
                 if i < min_value or i > max_value:
@@ -190,7 +337,7 @@ async def parse_indices(index_str: str, max_value: int, min_value: int = 1) -> l
 
 
 async def ASK_USER(question: str, options: list[UserSelectOption[T]]) -> list[UserSelectOption[T]]:
-    global NEEDS_PREFIX
+    global NEEDS_PREFIX, _OUTPUT_HELD
 
     while True:
         # print the options
@@ -205,14 +352,16 @@ async def ASK_USER(question: str, options: list[UserSelectOption[T]]) -> list[Us
             option_str = ""
             if len(options) > 1:
                 option_str = f"/1-{len(options)}"
-            async with PRINT_LOCK:
+            async with _get_input_lock():
+                flush_output()
                 print_prefix()
+                sys.stdout.write(f"{_PROMPT_START}{question}{END} {PURPLE}(y/n{option_str}){LIGHT_GRAY} ")
+                sys.stdout.flush()
+                # other tasks keep running while waiting for the answer, but their output is
+                # queued until the prompt is answered, so it cannot break into the prompt line
+                _OUTPUT_HELD = True
                 try:
-                    answer = (
-                        await async_input_non_blocking(
-                            f"{PURPLE}{BOLD}> {UNDERLINE}{question}{END} {PURPLE}(y/n{option_str}){LIGHT_GRAY} "
-                        )
-                    ).lower()
+                    answer = (await async_input_non_blocking("")).lower()
                 except:
                     # when error, we need to end the line
                     print()  # complete the newline
@@ -220,6 +369,8 @@ async def ASK_USER(question: str, options: list[UserSelectOption[T]]) -> list[Us
                 finally:
                     # always reset the prefix after user input
                     NEEDS_PREFIX = True
+                    _OUTPUT_HELD = False
+                    flush_output()
 
             if answer in ["y", "yes"]:
                 return options
@@ -1,6 +1,6 @@
-from dataclasses import dataclass, fields
-from typing import Generator, Iterable, Optional, Union, Set
-from .printer import aERROR_EXIT, WARN
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+from .printer import WARN
 
 USER_EXPORT = {}
 
@@ -25,7 +25,7 @@ def export(function):
     return function
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Package:
     """
     A class that represents a package.
@@ -36,16 +36,23 @@ class Package:
     add_cmd_part: Optional[str] = None
     extra: Optional[str] = None
     metadata: Optional[dict] = None
+    # packages are hashed repeatedly when diffing states, and the name never changes
+    _hash: int = field(init=False, repr=False, compare=False)
+    # whether only the name is present; checked on every comparison against a plain string
+    is_unit: bool = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
+        # the instance is frozen, hence the normalisation below has to bypass __setattr__
         if self.add_cmd_part and self.extra:
             raise ValueError("Cannot have both add_cmd_part and extra")
         if not self.extra:  # avoid whitespace
-            self.extra = None
+            object.__setattr__(self, "extra", None)
         if (
             not self.add_cmd_part or self.add_cmd_part == self.name
         ):  # pointless to store add_cmd_part if its the same as name
-            self.add_cmd_part = None
+            object.__setattr__(self, "add_cmd_part", None)
+        object.__setattr__(self, "_hash", hash(self.equality_key))
+        object.__setattr__(self, "is_unit", self.add_cmd_part is None and self.extra is None and not self.metadata)
 
     def get_add_cmd_part(self):
         if self.add_cmd_part:
@@ -55,7 +62,8 @@ class Package:
         return self.name
 
     def __lt__(self, other):
-        return self.equality_key < other.equality_key
+        # same as comparing equality_key, without the property call
+        return self.name < other.name
 
     @property
     def equality_key(self):
@@ -65,23 +73,32 @@ class Package:
         # return (self.name, self.add_cmd_part, self.extra)
         return self.name
 
-    @property
-    def is_unit(self):
+    @classmethod
+    def intern(cls, name: str, add_cmd_part: Optional[str] = None, extra: Optional[str] = None) -> "Package":
         """
-        Check if the package is a unit.
+        Get the canonical instance for the given package declaration.
+        The same package is often declared multiple times (e.g. across managers), and since
+        packages are immutable, the declarations can share one instance.
         """
-        return self.add_cmd_part is None and self.extra is None and not self.metadata
+        key = (name, add_cmd_part, extra)
+        pkg = _PACKAGE_INTERN.get(key)
+        if pkg is None:
+            pkg = _PACKAGE_INTERN[key] = cls(name, add_cmd_part=add_cmd_part, extra=extra)
+        return pkg
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, Package):
-            return self.equality_key == other.equality_key
+            # same as comparing equality_key, without the property call
+            return self.name == other.name
         elif isinstance(other, str) and self.is_unit:
             # If the other is a string and the package is a unit, we can compare by name
             return self.name == other
         raise NotImplementedError(f"Cannot compare Package with {type(other)}.")
 
     def __hash__(self):
-        return hash(self.equality_key)
+        return self._hash
 
     def get_config_repr(self):
         """
@@ -96,103 +113,143 @@ class Package:
             # Only the name is present, so we return just the name
             return self.name
 
-        # Automatically collect non-None and non-empty fields
+        # the optional fields are spelled out, instead of iterating over the dataclass fields on every call
         field_strs = [f"{self.name!r}"]
-
-        field_strs.extend(
-            [
-                f"{f.name}={repr(getattr(self, f.name))}"
-                for f in fields(self)
-                if f.name != "name" and getattr(self, f.name) is not None
-            ]
-        )
+        if self.add_cmd_part is not None:
+            field_strs.append(f"add_cmd_part={self.add_cmd_part!r}")
+        if self.extra is not None:
+            field_strs.append(f"extra={self.extra!r}")
+        if self.metadata is not None:
+            field_strs.append(f"metadata={self.metadata!r}")
 
         return f"Package({', '.join(field_strs)})"
 
 
+# canonical Package instances created by Package.intern
+_PACKAGE_INTERN: Dict[Tuple[str, Optional[str], Optional[str]], Package] = {}
+
+
 def ensure_package(
     package: Union[str, Package, Iterable[Package]],
-) -> Generator[Package, None, None]:
+) -> List[Package]:
     """
     Ensure that the package is a Package instance.
+    Nested iterables of packages are flattened, in order.
     """
+    # fast path for the common single package case
     if isinstance(package, str):
-        yield Package(package)
-        return
-    elif isinstance(package, Package):
-        yield package
-        return
-    else:
-        try:
-            some_object_iterator = iter(package)
-        except TypeError:
-            # not iterable.
-            aERROR_EXIT(
-                f"Package {package} is not a string, Package instance, nor list of Packages. Please check your configuration."
-            )
-        for pkg in some_object_iterator:
-            yield from ensure_package(pkg)
+        return [Package.intern(package)]
+    if isinstance(package, Package):
+        return [package]
+
+    pkgs: List[Package] = []
+    stack: List[Any] = [package]
+    while stack:
+        pkg = stack.pop()
+        if isinstance(pkg, str):
+            pkgs.append(Package.intern(pkg))
+        elif isinstance(pkg, Package):
+            pkgs.append(pkg)
+        elif isinstance(pkg, (list, tuple)):
+            # the usual containers in configs, pushed directly without the iterable check below
+            stack.extend(reversed(pkg))
+        else:
+            try:
+                items = list(pkg)
+            except TypeError:
+                # not iterable.
+                raise TypeError(
+                    f"Package {pkg} is not a string, Package instance, nor list of Packages. "
+                    "Please check your configuration."
+                ) from None
+            stack.extend(reversed(items))
+    return pkgs
 
 
 class FalseDefaultDict:
     """
     A custom object that returns False for all attribute accesses unless explicitly set.
 
-    Attributes are stored internally in a dictionary. If an attribute is accessed
-    but has not been set, it returns False instead of raising an AttributeError.
+    Attributes are stored as regular instance attributes, so accessing a set attribute is a plain
+    attribute lookup. If an attribute is accessed but has not been set, it returns False instead of
+    raising an AttributeError.
     """
 
-    def __init__(self):
-        self._data = {}
-
     def __getattr__(self, name):
-        return self._data.get(name, False)
-
-    def __setattr__(self, name, value):
-        if name == "_data":
-            super().__setattr__(name, value)
-        else:
-            self._data[name] = value
+        # only called when the attribute does not exist
+        if name.startswith("__"):
+            # do not pretend to implement special protocols (e.g. copy / pickle hooks)
+            raise AttributeError(name)
+        return False
 
     def __delattr__(self, name):
-        if name in self._data:
-            del self._data[name]
+        self.__dict__.pop(name, None)
 
     def __repr__(self):
-        return "Data({})".format(",".join(f"{k}={v}" for (k, v) in self._data.items()))
+        return "Data({})".format(",".join(f"{k}={v}" for (k, v) in self.__dict__.items()))
+
 
+def _quote_pkgs(pkgs: List[Package]) -> str:
+    return ", ".join(f"'{pkg}'" for pkg in pkgs)
 
-@dataclass
+
+@dataclass(slots=True)
 class DeclaredPackageState:
     """
     A class that allows user to declare desire package state.
     """
 
     name: str
-    pkgs: Set[Package]
-    ignore_pkgs: Set[Package]
+    # keyed by package name, which is what packages are compared by
+    pkgs: Dict[str, Package]
+    # only the names are needed to filter out installed packages
+    ignore_pkgs: Set[str]
+
+    def __post_init__(self):
+        self.ignore_pkgs = {pkg.name if isinstance(pkg, Package) else pkg for pkg in self.ignore_pkgs}
 
     def add(self, package: Union[str, Package, Iterable[Package]]) -> "DeclaredPackageState":
+        if type(package) is str:
+            # fast path for the common `MANAGERS[...] << "name"`, no Package is needed for a duplicate
+            if package in self.pkgs:
+                WARN(f"'{package}' was already added to '{self.name}'.")
+            else:
+                self.pkgs[package] = Package.intern(package)
+            return self
+
+        # report all duplicates within one warning
+        duplicates = []
         for pkg in ensure_package(package):
-            if pkg in self.pkgs:
-                WARN(
-                    f"'{pkg}' was already added to '{self.name}'.",
-                )
+            if pkg.name in self.pkgs:
+                duplicates.append(pkg)
             else:
-                self.pkgs.add(pkg)
+                self.pkgs[pkg.name] = pkg
+        if duplicates:
+            verb = "was" if len(duplicates) == 1 else "were"
+            WARN(
+                f"{_quote_pkgs(duplicates)} {verb} already added to '{self.name}'.",
+            )
         return self
 
     def __lshift__(self, *args) -> "DeclaredPackageState":
         return self.add(*args)
 
     def remove(self, package: Union[str, Package, Iterable[Package]]) -> "DeclaredPackageState":
+        if type(package) is str:
+            # fast path for the common `MANAGERS[...] >> "name"`
+            if self.pkgs.pop(package, None) is None:
+                WARN(f"'{package}' does not exists in '{self.name}'.")
+            return self
+
+        missing = []
         for pkg in ensure_package(package):
-            try:
-                self.pkgs.remove(pkg)
-            except KeyError:
-                WARN(
-                    f"'{pkg}' does not exists in '{self.name}'.",
-                )
+            if self.pkgs.pop(pkg.name, None) is None:
+                missing.append(pkg)
+        if missing:
+            verb = "does not exists" if len(missing) == 1 else "do not exist"
+            WARN(
+                f"{_quote_pkgs(missing)} {verb} in '{self.name}'.",
+            )
         return self
 
     def __rshift__(self, *args) -> "DeclaredPackageState":
@@ -202,29 +259,23 @@ class DeclaredPackageState:
         """
         Ignore packages.
         """
-        for pkg in args:
-            self.ignore_pkgs.add(Package(pkg))
+        self.ignore_pkgs.update(args)
         return self
 
 
-@dataclass
+@dataclass(slots=True)
 class DeclaredPackageManagerRegistry:
     """
     A class to store the declared package managers.
     """
 
-    data_pair: dict[str, DeclaredPackageState]
-
-    def __init__(self):
-        self.data_pair = {}
+    data_pair: dict[str, DeclaredPackageState] = field(default_factory=dict)
 
     def __getitem__(self, item: str) -> DeclaredPackageState:
-        try:
-            return self.data_pair[item]
-        except KeyError:
-            pass
-        self.data_pair[item] = DeclaredPackageState(name=item, pkgs=set(), ignore_pkgs=set())
-        return self.data_pair[item]
+        state = self.data_pair.get(item)
+        if state is None:
+            state = self.data_pair[item] = DeclaredPackageState(name=item, pkgs={}, ignore_pkgs=set())
+        return state
 
 
 # This is a singleton object that stores the declared package managers.